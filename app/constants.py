@@ -1,3 +1,5 @@
+import os
+
 # Example data to load when the "Load Example" button is clicked
 
 ROLE_PLACEHOLDER = [
@@ -14,6 +16,11 @@ ROLE_PLACEHOLDER = [
     "e.g. Infrastructure Engineer",
 ]
 
+# Rows pre-built for the dynamic form, add/remove only toggles their visibility.
+# Every row is sent on page load, so raise these only as far as users need.
+MAX_ROLES = int(os.getenv("MAX_ROLES", "30"))
+MAX_EDUCATION = int(os.getenv("MAX_EDUCATION", "10"))
+
 SAMPLE_RESULT = """
 Based on the provided career profile, we can identify several potential career paths that align with the individual's experience, skills, and aspirations. 
 For each option, I’ll assess its performance in the short, medium, and long term for each criterion. I’ll assign rough scores (1-5, where 1 is low and 5 is high) based on your background and goals, then explain the reasoning.
@@ -3,29 +3,160 @@ import os
 import gradio as gr
 from dotenv import load_dotenv
 
-from app.constants import ROLE_PLACEHOLDER, SAMPLE_RESULT
-from app.utils import copy_to_clipboard, export_state
-from linkedinadvice.career_analysis import CareerAnalyzer
-from linkedinadvice.monitoring import monitor_api
+from app.constants import MAX_EDUCATION, MAX_ROLES, ROLE_PLACEHOLDER, SAMPLE_RESULT
+from app.utils import (
+    copy_to_clipboard,
+    export_state,
+    format_education_background,
+    format_professional_background,
+)
+from linkedinadvice.career_analysis import TIME_HORIZONS, CareerAnalyzer, client
+from linkedinadvice.monitoring import monitor_api, register_stats
+from linkedinadvice.transport import (
+    HedgedTransport,
+    OpenAITransport,
+    RecordingTransport,
+    ReplayTransport,
+    ResponseCache,
+)
 
 # Load environment variables
 load_dotenv()
 
-# Check if API key is set
-if not os.getenv("OPENAI_API_KEY"):
+# Transport mode: "live" (default), "record" or "replay"
+transport_mode = os.getenv("TRANSPORT_MODE", "live")
+cassette_path = os.getenv("CASSETTE_PATH", "cassette.jsonl")
+
+# Check if API key is set, replay runs fully offline
+if transport_mode != "replay" and not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY not found in environment variables")
 
+if transport_mode == "replay":
+    transport = ReplayTransport(
+        cassette_path, speed=float(os.getenv("REPLAY_SPEED", "1.0"))
+    )
+else:
+    transport = OpenAITransport(client)
+    # Opt-in hedging of slow upstream requests to cut tail latency
+    if os.getenv("HEDGE_REQUESTS", "").lower() in ("1", "true", "yes"):
+        transport = HedgedTransport(
+            transport,
+            percentile=float(os.getenv("HEDGE_PERCENTILE", "0.9")),
+            max_hedge_rate=float(os.getenv("HEDGE_MAX_RATE", "0.1")),
+        )
+        register_stats("Hedging", transport.stats)
+    if transport_mode == "record":
+        transport = RecordingTransport(transport, cassette_path)
+
+# Responses are only cached when warming from a cassette
+response_cache = None
+if os.getenv("WARM_CACHE_FROM"):
+    response_cache = ResponseCache(
+        max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+    )
+    response_cache.warm_from_cassette(os.getenv("WARM_CACHE_FROM"))
+
 # Initialize career analyzer
-analyzer = CareerAnalyzer(model_name="gpt-4o-mini")
+analyzer = CareerAnalyzer(
+    model_name="gpt-4o-mini", transport=transport, cache=response_cache
+)
 
 
 @monitor_api
 def analyze_career(
     *args,
 ):
-    result = analyzer.analyze(*args)
+    # Stream the analysis so partial results show up as they arrive
+    yield from analyzer.analyze_stream(*args)
+
+
+@monitor_api
+def compare_career_horizons(
+    *args,
+):
+    # Stream the comparison so each tab fills in as its section arrives
+    yield from analyzer.compare_horizons_stream(*args)
+
+
+def client_id(request):
+    """Identify the client a request's usage is charged to"""
+    if request is None or request.client is None:
+        return "anonymous"
+    return request.client.host
+
+
+def submit_analysis(
+    professional_background,
+    education_background,
+    goals,
+    insights,
+    time_preference,
+    financial_weight,
+    impact_weight,
+    opportunity_weight,
+    request: gr.Request,
+):
+    """Stream a single-horizon analysis for the submitting client"""
+    args = (
+        professional_background,
+        education_background,
+        goals,
+        insights,
+        time_preference,
+        financial_weight,
+        impact_weight,
+        opportunity_weight,
+    )
+    export_state(*args)
+    yield from analyze_career(*args, client_id=client_id(request))
+
+
+def show_horizons(
+    professional_background,
+    education_background,
+    goals,
+    insights,
+    financial_weight,
+    impact_weight,
+    opportunity_weight,
+    request: gr.Request,
+):
+    """Stream a multi-horizon comparison and spread it over the output tabs"""
+    for result in compare_career_horizons(
+        professional_background,
+        education_background,
+        goals,
+        insights,
+        financial_weight,
+        impact_weight,
+        opportunity_weight,
+        client_id=client_id(request),
+    ):
+        if isinstance(result, str):
+            # Request was rejected by the monitor
+            yield result, *("" for _ in TIME_HORIZONS)
+        else:
+            yield result["Taxonomy"], *(result[horizon] for horizon in TIME_HORIZONS)
+
+
+def update_role(field, i):
+    """Build the listener that stores one field of role row i"""
+
+    def listener(roles, r_count, value):
+        roles.setdefault(i, {})[field] = value
+        return roles, format_professional_background(roles, r_count)
+
+    return listener
 
-    return result
+
+def update_education(field, i):
+    """Build the listener that stores one field of education row i"""
+
+    def listener(educations, e_count, value):
+        educations.setdefault(i, {})[field] = value
+        return educations, format_education_background(educations, e_count)
+
+    return listener
 
 
 # Building the interface
@@ -59,6 +190,7 @@ with gr.Blocks(theme="soft") as demo:
 
     with gr.Row():
         submit_btn = gr.Button("Analyze Career Paths", variant="primary", size="lg")
+        compare_btn = gr.Button("Compare Horizons", variant="primary", size="lg")
         clear_btn = gr.Button("Clear", variant="stop", size="lg")
         example_btn = gr.Button("Load Example", variant="secondary", size="lg")
 
@@ -78,88 +210,23 @@ with gr.Blocks(theme="soft") as demo:
                         key="remove_role_btn",
                     )
 
-                    add_role_btn.click(
-                        lambda x: x + 1,
-                        inputs=[role_count],
-                        outputs=[role_count],
-                    )
-
-                    remove_role_btn.click(
-                        lambda x: max(x - 1, 1),
-                        inputs=[role_count],
-                        outputs=[role_count],
-                    )
-
-                @gr.render(inputs=role_count)
-                def render_roles(r_count):
-                    for i in range(r_count):
-                        if i not in professional_background_dict.value:
-                            professional_background_dict.value[i] = {
-                                "role": "",
-                                "exp": "",
-                                "professional_achievement": "",
-                            }
+                role_rows = []
+                for i in range(MAX_ROLES):
+                    with gr.Column(visible=i == 0) as role_row:
                         with gr.Row():
-                            interactive = i == r_count - 1
                             role = gr.Textbox(
                                 key=f"role_{i}",
                                 label=f"Role {i + 1}"
                                 + (" (Current)" if i == 0 else ""),
                                 placeholder=ROLE_PLACEHOLDER[i % len(ROLE_PLACEHOLDER)],
                                 scale=3,
-                                interactive=interactive,
-                                inputs=professional_background_dict.value[i].get(
-                                    "role", ""
-                                ),
-                            )
-
-                            def update_professional_background_dict(key, value, i):
-                                professional_background_dict.value[i][key] = value
-                                final_string = ""
-                                for i in professional_background_dict.value:
-                                    role = professional_background_dict.value[i].get(
-                                        "role"
-                                    )
-                                    exp = professional_background_dict.value[i].get(
-                                        "exp"
-                                    )
-                                    professional_achievement = (
-                                        professional_background_dict.value[i].get(
-                                            "professional_achievement"
-                                        )
-                                    )
-                                    final_string += f"{role} - {exp} years. Achieved: \n{professional_achievement}\n\n"
-
-                                return professional_background_dict.value, final_string
-
-                            role.input(
-                                lambda x: update_professional_background_dict(
-                                    "role", x, i
-                                ),
-                                inputs=[role],
-                                outputs=[
-                                    professional_background_dict,
-                                    professional_background,
-                                ],
                             )
-
                             exp = gr.Number(
                                 key=f"exp_{i}",
                                 label="Years",
                                 value=1,
                                 minimum=0,
                                 scale=1,
-                                interactive=interactive,
-                            )
-                            exp.input(
-                                lambda x: update_professional_background_dict(
-                                    "exp", x, i
-                                ),
-                                inputs=[exp],
-                                outputs=[
-                                    professional_background_dict,
-                                    professional_background,
-                                ],
                             )
 
                         professional_achievement = gr.Textbox(
@@ -167,23 +234,63 @@ with gr.Blocks(theme="soft") as demo:
                             label="Notable Achievements",
                             lines=2,
                             placeholder="List key accomplishments, awards, or significant contributions.",
-                            interactive=interactive,
                         )
 
-                        professional_achievement.input(
-                            lambda x: update_professional_background_dict(
-                                "professional_achievement", x, i
-                            ),
-                            inputs=[professional_achievement],
+                    # Each listener only sends its own field, combined data stays server-side
+                    for field, component in (
+                        ("role", role),
+                        ("exp", exp),
+                        ("professional_achievement", professional_achievement),
+                    ):
+                        component.input(
+                            update_role(field, i),
+                            inputs=[professional_background_dict, role_count, component],
                             outputs=[
                                 professional_background_dict,
                                 professional_background,
                             ],
                         )
 
-                        raw_list_inputs.value.extend(
-                            [role, exp, professional_achievement]
+                    role_rows.append(role_row)
+                    raw_list_inputs.value.extend([role, exp, professional_achievement])
+
+                def add_role(roles, r_count):
+                    if r_count >= MAX_ROLES:
+                        gr.Warning(
+                            f"You can add at most {MAX_ROLES} roles. "
+                            "Combine earlier roles to make room."
                         )
+                        return {role_count: r_count}
+                    return {
+                        role_count: r_count + 1,
+                        role_rows[r_count]: gr.update(visible=True),
+                        professional_background: format_professional_background(
+                            roles, r_count + 1
+                        ),
+                    }
+
+                def remove_role(roles, r_count):
+                    if r_count <= 1:
+                        return {role_count: r_count}
+                    return {
+                        role_count: r_count - 1,
+                        role_rows[r_count - 1]: gr.update(visible=False),
+                        professional_background: format_professional_background(
+                            roles, r_count - 1
+                        ),
+                    }
+
+                add_role_btn.click(
+                    add_role,
+                    inputs=[professional_background_dict, role_count],
+                    outputs=[role_count, professional_background, *role_rows],
+                )
+
+                remove_role_btn.click(
+                    remove_role,
+                    inputs=[professional_background_dict, role_count],
+                    outputs=[role_count, professional_background, *role_rows],
+                )
 
             with gr.Group():
                 gr.Markdown("### Educational Background")
@@ -203,83 +310,80 @@ with gr.Blocks(theme="soft") as demo:
                         key="remove_education_btn",
                     )
 
-                    add_education_btn.click(
-                        lambda x: x + 1,
-                        inputs=[education_count],
-                        outputs=[education_count],
-                    )
-
-                    remove_education_btn.click(
-                        lambda x: max(x - 1, 1),
-                        inputs=[education_count],
-                        outputs=[education_count],
-                    )
-
-                @gr.render(inputs=education_count)
-                def render_education(e_count):
-                    for i in range(e_count):
-                        if i not in education_background_dict.value:
-                            education_background_dict.value[i] = {
-                                "education": "",
-                                "education_achievement": "",
-                            }
-                        with gr.Row():
-                            education = gr.Textbox(
-                                key=f"education_{i}",
-                                label="Academic Experience",
-                                lines=3,
-                                placeholder="e.g. Bachelor of Science in Computer Science, University of Technology",
-                            )
+                education_rows = []
+                for i in range(MAX_EDUCATION):
+                    with gr.Row(visible=i == 0) as education_row:
+                        education = gr.Textbox(
+                            key=f"education_{i}",
+                            label="Academic Experience",
+                            lines=3,
+                            placeholder="e.g. Bachelor of Science in Computer Science, University of Technology",
+                        )
 
-                            def update_educational_background_dict(key, value, i):
-                                education_background_dict.value[i][key] = value
-                                final_string = ""
-                                for i in education_background_dict.value:
-                                    education = education_background_dict.value[i].get(
-                                        "education"
-                                    )
-                                    edu_achievement = education_background_dict.value[
-                                        i
-                                    ].get("edu_achievement")
-                                    final_string += f"{education}. Achieved: \n{edu_achievement}\n\n"
-
-                                return education_background_dict.value, final_string
-
-                            education.input(
-                                lambda x: update_educational_background_dict(
-                                    "education", x, i
-                                ),
-                                inputs=[education],
-                                outputs=[
-                                    education_background_dict,
-                                    education_background,
-                                ],
-                            )
+                        edu_achievement = gr.Textbox(
+                            key=f"edu_achievement_{i}",
+                            label="Academic Achievements",
+                            lines=3,
+                            placeholder="Awards, honors, notable projects or research during your education",
+                        )
 
-                            edu_achievement = gr.Textbox(
-                                key=f"edu_achievement_{i}",
-                                label="Academic Achievements",
-                                lines=3,
-                                placeholder="Awards, honors, notable projects or research during your education",
-                            )
+                    for field, component in (
+                        ("education", education),
+                        ("education_achievement", edu_achievement),
+                    ):
+                        component.input(
+                            update_education(field, i),
+                            inputs=[
+                                education_background_dict,
+                                education_count,
+                                component,
+                            ],
+                            outputs=[
+                                education_background_dict,
+                                education_background,
+                            ],
+                        )
 
-                            edu_achievement.input(
-                                lambda x: update_educational_background_dict(
-                                    "education_achievement", x, i
-                                ),
-                                inputs=[education_achievements],
-                                outputs=[
-                                    education_background_dict,
-                                    education_background,
-                                ],
-                            )
+                    education_rows.append(education_row)
+                    raw_list_inputs.value.extend([education, edu_achievement])
 
-                        if education.value:
-                            education_background.value += education.value
-                        if edu_achievement.value:
-                            education_achievements.value += edu_achievement.value
+                def add_education(educations, e_count):
+                    if e_count >= MAX_EDUCATION:
+                        gr.Warning(
+                            f"You can add at most {MAX_EDUCATION} academic "
+                            "experiences. Combine earlier entries to make room."
+                        )
+                        return {education_count: e_count}
+                    return {
+                        education_count: e_count + 1,
+                        education_rows[e_count]: gr.update(visible=True),
+                        education_background: format_education_background(
+                            educations, e_count + 1
+                        ),
+                    }
+
+                def remove_education(educations, e_count):
+                    if e_count <= 1:
+                        return {education_count: e_count}
+                    return {
+                        education_count: e_count - 1,
+                        education_rows[e_count - 1]: gr.update(visible=False),
+                        education_background: format_education_background(
+                            educations, e_count - 1
+                        ),
+                    }
+
+                add_education_btn.click(
+                    add_education,
+                    inputs=[education_background_dict, education_count],
+                    outputs=[education_count, education_background, *education_rows],
+                )
 
-                        raw_list_inputs.value.extend([education, edu_achievement])
+                remove_education_btn.click(
+                    remove_education,
+                    inputs=[education_background_dict, education_count],
+                    outputs=[education_count, education_background, *education_rows],
+                )
 
             with gr.Group():
                 gr.Markdown("### Future Plans")
@@ -304,11 +408,7 @@ with gr.Blocks(theme="soft") as demo:
                 )
 
                 time_preference = gr.Radio(
-                    [
-                        "Short-term (3 years)",
-                        "Mid-term (10 years)",
-                        "Long-term (10+ years)",
-                    ],
+                    TIME_HORIZONS,
                     label="Time Horizon Preference",
                     value="Mid-term (10 years)",
                     key="time_preference",
@@ -344,13 +444,26 @@ with gr.Blocks(theme="soft") as demo:
                         )
 
         with gr.Column(scale=2):
-            output_box = gr.Markdown(
-                output.value,
-                container=True,
-                height=614,
-                show_copy_button=True,
-                key="output_box",
-            )
+            with gr.Tabs():
+                with gr.Tab("Analysis"):
+                    output_box = gr.Markdown(
+                        output.value,
+                        container=True,
+                        height=614,
+                        show_copy_button=True,
+                        key="output_box",
+                    )
+                horizon_boxes = []
+                for horizon in TIME_HORIZONS:
+                    with gr.Tab(horizon):
+                        horizon_boxes.append(
+                            gr.Markdown(
+                                container=True,
+                                height=614,
+                                show_copy_button=True,
+                                key=f"horizon_box_{horizon}",
+                            )
+                        )
 
             with gr.Row():
                 copy_btn = gr.Button("📋 Copy to Clipboard", variant="secondary")
@@ -385,7 +498,7 @@ with gr.Blocks(theme="soft") as demo:
                 )
 
     submit_btn.click(
-        lambda *args: analyze_career(*args) if export_state(*args) or True else None,
+        submit_analysis,
         inputs=[
             professional_background,
             education_background,
@@ -399,6 +512,20 @@ with gr.Blocks(theme="soft") as demo:
         outputs=[output_box],
     )
 
+    compare_btn.click(
+        show_horizons,
+        inputs=[
+            professional_background,
+            education_background,
+            goals,
+            insights,
+            financial_weight,
+            impact_weight,
+            opportunity_weight,
+        ],
+        outputs=[output_box, *horizon_boxes],
+    )
+
     clear_btn.click(
         fn=lambda: None, inputs=[], outputs=[], js="() => location.reload()"
     )
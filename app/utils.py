@@ -39,3 +39,30 @@ def export_state(
     formatted_output = "\n".join(f"{key}: {value}" for key, value in state_dict.items())
 
     return formatted_output
+
+
+def format_professional_background(roles, role_count) -> str:
+    """Combine the first role_count role entries into the prompt string"""
+    final_string = ""
+    for i in range(role_count):
+        entry = roles.get(i, {})
+        role = entry.get("role", "")
+        exp = entry.get("exp", 1)
+        professional_achievement = entry.get("professional_achievement", "")
+        final_string += (
+            f"{role} - {exp} years. Achieved: \n{professional_achievement}\n\n"
+        )
+
+    return final_string
+
+
+def format_education_background(educations, education_count) -> str:
+    """Combine the first education_count education entries into the prompt string"""
+    final_string = ""
+    for i in range(education_count):
+        entry = educations.get(i, {})
+        education = entry.get("education", "")
+        edu_achievement = entry.get("education_achievement", "")
+        final_string += f"{education}. Achieved: \n{edu_achievement}\n\n"
+
+    return final_string
@@ -3,19 +3,54 @@ import os
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from linkedinadvice.monitoring import (
+    QUOTA_EXCEEDED_MESSAGE,
+    profiler,
+    quota_ledger,
+)
+from linkedinadvice.transport import OpenAITransport
+
 load_dotenv()
 
-# Initialize the OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Initialize the OpenAI client, offline replay runs without an API key
+client = (
+    OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    if os.getenv("OPENAI_API_KEY")
+    else None
+)
+
+SYSTEM_PROMPT = "You are a career advisor specialized in professional path analysis. Your analysis should be comprehensive, data-driven, and tailored to the individual's specific career history and goals."
+
+TIME_HORIZONS = [
+    "Short-term (3 years)",
+    "Mid-term (10 years)",
+    "Long-term (10+ years)",
+]
+
+# Heading prefix used to split a multi-horizon response into sections
+HORIZON_MARKER = "Horizon:"
+
+# Distinctive start of each section heading, matched case-insensitively
+HORIZON_PREFIXES = {
+    "taxonomy": "Taxonomy",
+    "short": TIME_HORIZONS[0],
+    "mid": TIME_HORIZONS[1],
+    "medium": TIME_HORIZONS[1],
+    "long": TIME_HORIZONS[2],
+}
 
 
 class CareerAnalyzer:
     """Handles career path analysis using OpenAI models"""
 
-    def __init__(self, model_name="gpt-4o-mini", temperature=0.0):
+    def __init__(
+        self, model_name="gpt-4o-mini", temperature=0.0, transport=None, cache=None
+    ):
         """Initialize with the specified model parameters"""
         self.model_name = model_name
         self.temperature = temperature
+        self.transport = transport or OpenAITransport(client)
+        self.cache = cache  # Optional ResponseCache consulted before the transport
 
     def analyze(
         self,
@@ -39,11 +74,174 @@ class CareerAnalyzer:
         Returns:
             str: Formatted analysis results
         """
-        # Use default equal weights if none provided
+        with profiler.span("build_prompt"):
+            prompt = self._build_prompt(
+                professional_background,
+                education_background,
+                goals,
+                insights,
+                time_preference,
+                financial_weight,
+                impact_weight,
+                opportunity_weight,
+            )
+
+        return self._complete(prompt)
+
+    def compare_horizons(
+        self,
+        professional_background,
+        education_background,
+        goals,
+        insights,
+        financial_weight,
+        impact_weight,
+        opportunity_weight,
+    ):
+        """
+        Analyze career paths for every time horizon in a single request
+
+        The taxonomy of career paths is generated once and each horizon view
+        is scored against it, instead of resubmitting the profile per horizon.
+
+        Returns:
+            dict: Shared taxonomy under "Taxonomy" and one analysis per horizon
+        """
+        with profiler.span("build_prompt"):
+            prompt = self._build_comparison_prompt(
+                professional_background,
+                education_background,
+                goals,
+                insights,
+                financial_weight,
+                impact_weight,
+                opportunity_weight,
+            )
+
+        result = self._complete(prompt)
+        return self._split_horizons(result)
+
+    def analyze_stream(self, *args):
+        """
+        Analyze career paths, yielding the accumulated result as it streams in
+
+        Args:
+            *args: Same positional arguments as analyze
+
+        Yields:
+            str: Analysis text received so far
+        """
+        with profiler.span("build_prompt"):
+            prompt = self._build_prompt(*args)
+
+        yield from self._stream(prompt)
+
+    def compare_horizons_stream(self, *args):
+        """
+        Compare every time horizon in a single request, streaming the sections
+
+        Args:
+            *args: Same positional arguments as compare_horizons
+
+        Yields:
+            dict: Sections received so far, keyed like compare_horizons
+        """
+        with profiler.span("build_prompt"):
+            prompt = self._build_comparison_prompt(*args)
+
+        # Sections not started yet stay empty until the response is complete
+        result = ""
+        for result in self._stream(prompt):
+            yield self._split_horizons(result, fallback=False)
+        yield self._split_horizons(result)
+
+    def _stream(self, prompt):
+        """Stream a prompt upstream, yielding the accumulated result"""
+        request, result = self._prepare(prompt)
+        if result is not None:
+            yield result
+            return
+
+        result = ""
+        try:
+            # Stream the API call
+            with profiler.span("upstream_call"):
+                for chunk in self.transport.stream(request):
+                    result += chunk
+                    yield result
+        except Exception as e:
+            # Handle API errors gracefully
+            yield f"An error occurred during analysis: {str(e)}"
+            return
+
+        if self.cache is not None:
+            self.cache.put(request, result)
+
+    def _complete(self, prompt):
+        """Send a prompt upstream, going through the cache when configured"""
+        request, result = self._prepare(prompt)
+        if result is not None:
+            return result
+
+        try:
+            # Make the API call
+            with profiler.span("upstream_call"):
+                result = self.transport.complete(request)
+
+            if self.cache is not None:
+                self.cache.put(request, result)
+
+            # Return the result
+            return result
+        except Exception as e:
+            # Handle API errors gracefully
+            return f"An error occurred during analysis: {str(e)}"
+
+    def _prepare(self, prompt):
+        """
+        Log a prompt and build its request
+
+        Returns:
+            tuple: The request, and a ready result when it is cached or over quota
+        """
+        # Print the prompt for debugging
+        with profiler.span("log_prompt"):
+            print("\n=== CAREER ANALYSIS PROMPT ===\n")
+            print(prompt)
+            print("\n=== END OF PROMPT ===\n")
+
+        request = self._build_request(prompt)
+
+        # Serve repeated requests from the cache when one is configured
+        if self.cache is not None:
+            cached = self.cache.get(request)
+            if cached is not None:
+                return request, cached
+
+        # Pre-check the budget with a local estimate of the prompt tokens
+        if not quota_ledger.check(self.model_name, prompt):
+            return request, QUOTA_EXCEEDED_MESSAGE
+
+        return request, None
+
+    def _build_request(self, prompt):
+        """Build the chat completion request for a prompt"""
+        return {
+            "model": self.model_name,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            "temperature": self.temperature,
+        }
+
+    def _build_profile(
+        self, professional_background, education_background, goals, insights
+    ):
+        """Assemble the career profile section shared by every prompt"""
         current_role = professional_background.split("\n\n")[0]
         previous_roles = "\n\n".join(professional_background.split("\n\n")[1:])
 
-
         # Create the prompt with all available information
         prompt = f"""Analyze the following career profile and generate a taxonomy of potential career paths:
 
@@ -59,7 +257,27 @@ Current Role: {current_role}
 Educational Background: {education_background}
 Career Goals: {goals}
 Additional Insights: {insights}
+"""
+
+        return prompt
+
+    def _build_prompt(
+        self,
+        professional_background,
+        education_background,
+        goals,
+        insights,
+        time_preference,
+        financial_weight,
+        impact_weight,
+        opportunity_weight,
+    ):
+        """Assemble the user prompt from the career profile"""
+        prompt = self._build_profile(
+            professional_background, education_background, goals, insights
+        )
 
+        prompt += f"""
 Time Preference: {time_preference}
 Financial Weight: {financial_weight}
 Impact Weight: {impact_weight}
@@ -84,27 +302,87 @@ Format the output clearly with sections for each career path, the scoring breakd
         if False:
             prompt += "\nPlease include at least one novel or unconventional career path in your analysis."
 
-        # Print the prompt for debugging
-        print("\n=== CAREER ANALYSIS PROMPT ===\n")
-        print(prompt)
-        print("\n=== END OF PROMPT ===\n")
+        return prompt
 
-        try:
-            # Make the API call
-            response = client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a career advisor specialized in professional path analysis. Your analysis should be comprehensive, data-driven, and tailored to the individual's specific career history and goals.",
-                    },
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=self.temperature,
-            )
+    def _build_comparison_prompt(
+        self,
+        professional_background,
+        education_background,
+        goals,
+        insights,
+        financial_weight,
+        impact_weight,
+        opportunity_weight,
+    ):
+        """Assemble a prompt covering every time horizon with a shared taxonomy"""
+        prompt = self._build_profile(
+            professional_background, education_background, goals, insights
+        )
 
-            # Extract and return the result
-            return response.choices[0].message.content
-        except Exception as e:
-            # Handle API errors gracefully
-            return f"An error occurred during analysis: {str(e)}"
+        sections = "\n".join(
+            f"{HORIZON_MARKER} {horizon}" for horizon in TIME_HORIZONS
+        )
+
+        prompt += f"""
+Financial Weight: {financial_weight}
+Impact Weight: {impact_weight}
+Opportunity Weight: {opportunity_weight}
+
+Help me as an expert career advisor. First provide a single taxonomy of promising career paths, under the heading "{HORIZON_MARKER} Taxonomy". Then, reusing exactly the same paths, compare them on each of the following timescales, each under its own heading:
+{sections}
+
+For each timescale and each path, evaluate:
+1. Financial potential (scale 1-3)
+2. Human impact potential (scale 1-3)
+3. Opportunity creation potential (scale 1-3)
+
+Show your step by step reasoning for each score.
+
+Then calculate an accurate weighted average based on the following weights:
+- Financial: {financial_weight}
+- Human Impact: {impact_weight}
+- Opportunity Creation: {opportunity_weight}
+
+Close each timescale section with a recommendation ranking the paths from highest to lowest score for that timescale. Use the headings exactly as written above.
+"""
+
+        return prompt
+
+    def _split_horizons(self, result, fallback=True):
+        """Split a comparison response into its taxonomy and horizon sections"""
+        sections = {}
+        current = None
+        for line in result.splitlines(keepends=True):
+            # Ignore markdown heading and emphasis markup and a trailing colon
+            stripped = line.strip()
+            heading = stripped.lstrip("#").replace("*", "").replace("__", "")
+            heading = heading.strip().rstrip(":").strip()
+            marked = heading.lower().startswith(HORIZON_MARKER.lower())
+            if marked:
+                heading = heading[len(HORIZON_MARKER) :].strip()
+
+            key = None
+            if marked or stripped.startswith(("#", "**", "__")):
+                key = next(
+                    (
+                        key
+                        for prefix, key in HORIZON_PREFIXES.items()
+                        if heading.lower().startswith(prefix)
+                    ),
+                    None,
+                )
+
+            # Each section starts at its first heading, other lines stay in the
+            # section they follow
+            if key is not None and key not in sections:
+                current = key
+                sections[current] = ""
+            elif current is not None:
+                sections[current] += line
+
+        # Fall back to the whole response only for sections the model left out
+        missing = result if fallback else ""
+        return {
+            key: sections.get(key, missing).strip()
+            for key in ("Taxonomy", *TIME_HORIZONS)
+        }
@@ -1,5 +1,13 @@
+import contextvars
+import inspect
+import json
 import logging
+import os
+import random
+import sys
+import threading
 import time
+from contextlib import contextmanager
 from functools import wraps
 
 # Configure logging
@@ -18,18 +26,6 @@ class APIMonitor:
 
     def __init__(self):
         self.request_count = 0
-        self.last_reset = time.time()
-        self.daily_limit = 100  # Adjust based on your budget
-
-    def check_limit(self):
-        """Check if the API request limit has been reached"""
-        # Reset counter if a new day has begun
-        current_time = time.time()
-        if (current_time - self.last_reset) > 86400:  # 24 hours
-            self.request_count = 0
-            self.last_reset = current_time
-
-        return self.request_count < self.daily_limit
 
     def log_request(self, user_input_length):
         """Log an API request and increment counter"""
@@ -39,26 +35,492 @@ class APIMonitor:
         )
 
 
+# Prices in USD per 1M tokens as (prompt, completion)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+
+def estimate_tokens(text):
+    """Cheap local token estimate, roughly 4 characters per token"""
+    return len(text) // 4 + 1
+
+
+# Token and cost based quota
+class QuotaLedger:
+    """Tracks token usage and cost per request against hourly and daily budgets"""
+
+    def __init__(
+        self,
+        path="quota_ledger.jsonl",
+        daily_budget=1.00,
+        hourly_budget=0.25,
+        client_daily_budget=0.20,
+        client_hourly_budget=0.05,
+        prices=MODEL_PRICES,
+        expected_completion_tokens=1500,
+    ):
+        self.path = path
+        self.budgets = {
+            86400: (daily_budget, client_daily_budget),  # 24 hours
+            3600: (hourly_budget, client_hourly_budget),  # 1 hour
+        }
+        self.prices = prices
+        self.expected_completion_tokens = expected_completion_tokens
+        self.entries = []  # (timestamp, client, cost) within the last 24 hours
+        self.current_client = contextvars.ContextVar(
+            "quota_client", default="anonymous"
+        )
+        self._lock = threading.Lock()
+        self._load()
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        """Convert token counts to USD with the price table"""
+        if model not in self.prices:
+            # Unknown models are charged at the most expensive known rate
+            prompt_price, completion_price = max(self.prices.values())
+        else:
+            prompt_price, completion_price = self.prices[model]
+        return (
+            prompt_tokens * prompt_price + completion_tokens * completion_price
+        ) / 1_000_000
+
+    def check(self, model=None, prompt=""):
+        """Check whether the current client can afford a request for this prompt"""
+        estimate = 0.0
+        if model is not None:
+            estimate = self.cost(
+                model, estimate_tokens(prompt), self.expected_completion_tokens
+            )
+
+        client = self.current_client.get()
+        with self._lock:
+            self._prune()
+            now = time.time()
+            for window, (budget, client_budget) in self.budgets.items():
+                spent = 0.0
+                client_spent = 0.0
+                for timestamp, entry_client, cost in self.entries:
+                    if now - timestamp <= window:
+                        spent += cost
+                        if entry_client == client:
+                            client_spent += cost
+                if (
+                    spent + estimate > budget
+                    or client_spent + estimate > client_budget
+                ):
+                    logger.warning(
+                        f"Quota exceeded for {client}: ${client_spent:.4f} of "
+                        f"${client_budget:.4f}, ${spent:.4f} of ${budget:.4f} "
+                        f"in the last {window // 3600} hours"
+                    )
+                    return False
+        return True
+
+    def record_usage(self, model, prompt_tokens, completion_tokens):
+        """Charge actual token usage of an upstream call to the current client"""
+        client = self.current_client.get()
+        cost = self.cost(model, prompt_tokens, completion_tokens)
+        entry = {
+            "timestamp": time.time(),
+            "client": client,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost": cost,
+        }
+
+        with self._lock:
+            self.entries.append((entry["timestamp"], client, cost))
+            # Keep a running average to estimate completions of future requests
+            self.expected_completion_tokens = int(
+                0.9 * self.expected_completion_tokens + 0.1 * completion_tokens
+            )
+            try:
+                # A leading newline keeps a line torn by a crash from swallowing
+                # this entry
+                with open(self._day_path(entry["timestamp"]), "a") as f:
+                    f.write("\n" + json.dumps(entry, separators=(",", ":")))
+            except OSError as e:
+                logger.error(f"Could not persist quota ledger entry: {e}")
+
+        logger.info(
+            f"Usage for {client}: {prompt_tokens} prompt + {completion_tokens} "
+            f"completion tokens on {model} (${cost:.5f})"
+        )
+
+    def _prune(self):
+        """Drop entries older than the longest budget window"""
+        cutoff = time.time() - max(self.budgets)
+        self.entries = [entry for entry in self.entries if entry[0] >= cutoff]
+
+    def _day_path(self, timestamp):
+        """Ledger file holding the entries of one UTC day"""
+        base, ext = os.path.splitext(self.path)
+        return f"{base}-{time.strftime('%Y%m%d', time.gmtime(timestamp))}{ext}"
+
+    def _load(self):
+        """Load recent entries from the daily files and delete expired ones"""
+        now = time.time()
+        cutoff = now - max(self.budgets)
+
+        # Entries of the last 24 hours live in today's and yesterday's files
+        keep = {
+            os.path.abspath(self._day_path(now)),
+            os.path.abspath(self._day_path(cutoff)),
+        }
+        base, ext = os.path.splitext(self.path)
+        directory = os.path.dirname(base) or "."
+        prefix = os.path.basename(base) + "-"
+        for name in os.listdir(directory):
+            path = os.path.abspath(os.path.join(directory, name))
+            day = name.removeprefix(prefix).removesuffix(ext)
+            if (
+                name.startswith(prefix)
+                and name.endswith(ext)
+                and day.isdigit()
+                and len(day) == 8
+                and path not in keep
+            ):
+                # Whole expired days are removed instead of rewriting a file
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.error(f"Could not remove expired quota ledger: {e}")
+
+        for path in sorted(keep):
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        timestamp = float(entry["timestamp"])
+                        client = str(entry["client"])
+                        cost = float(entry["cost"])
+                    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                        continue  # Skip a line torn by a crash or malformed
+                    if timestamp >= cutoff:
+                        self.entries.append((timestamp, client, cost))
+
+        logger.info(
+            f"Loaded {len(self.entries)} quota ledger entries from {self.path}"
+        )
+
+
+# Request profiling
+class RequestProfiler:
+    """Records named timing spans per request and samples stacks of slow requests"""
+
+    def __init__(
+        self,
+        enabled=False,
+        slow_threshold=5.0,
+        sample_rate=0.1,
+        sample_interval=0.01,
+        max_samples=2000,
+        output_dir="profiles",
+        max_dumps=50,
+    ):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold  # Seconds before a request counts as slow
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0)  # Share of requests armed
+        self.sample_interval = max(sample_interval, 0.001)  # Seconds between samples
+        self.max_samples = max_samples  # Hard cap on stack samples per request
+        self.output_dir = output_dir
+        self.max_dumps = max_dumps  # Oldest dumps are removed beyond this count
+        self._current = contextvars.ContextVar("request_trace", default=None)
+
+    @contextmanager
+    def span(self, name):
+        """Time a named stage of the current request, no-op outside a request"""
+        trace = self._current.get()
+        if trace is None:
+            yield
+            return
+
+        start = time.perf_counter()
+        idle = self._idle(trace)
+        try:
+            yield
+        finally:
+            # Time a streaming request spends paused between steps is excluded
+            trace["spans"].append(
+                {
+                    "name": name,
+                    "start": start - trace["start"],
+                    "duration": time.perf_counter()
+                    - start
+                    - (self._idle(trace) - idle),
+                }
+            )
+
+    @contextmanager
+    def profile_request(self, name):
+        """Trace a whole request and dump its profile if it turns out slow"""
+        if not self.enabled or self._current.get() is not None:
+            yield
+            return
+
+        trace = {
+            "name": name,
+            "start": time.perf_counter(),
+            "spans": [],
+            "sampler": None,
+            "idle": 0.0,  # Seconds a streaming request spent paused between steps
+            "paused_at": None,
+        }
+        token = self._current.set(trace)
+
+        # Only a fraction of requests get a sampler armed, to bound overhead
+        sampler = None
+        if random.random() < self.sample_rate:
+            sampler = _StackSampler(
+                threading.get_ident(),
+                delay=self.slow_threshold,
+                interval=self.sample_interval,
+                max_samples=self.max_samples,
+            )
+            sampler.start()
+            trace["sampler"] = sampler
+
+        try:
+            yield
+        finally:
+            # Only time spent working on the request counts towards slowness
+            elapsed = time.perf_counter() - trace["start"] - self._idle(trace)
+            self._current.reset(token)
+            stacks = sampler.stop() if sampler else {}
+
+            if elapsed > self.slow_threshold:
+                logger.warning(f"Slow request '{name}': {elapsed:.2f} seconds")
+                try:
+                    self._dump(trace, elapsed, stacks)
+                except OSError as e:
+                    logger.error(f"Could not write request profile: {e}")
+
+    def pause(self):
+        """Mark the current streaming request as paused between steps"""
+        trace = self._current.get()
+        if trace is None:
+            return
+        trace["paused_at"] = time.perf_counter()
+        if trace["sampler"] is not None:
+            trace["sampler"].thread_id = None
+
+    def resume(self):
+        """Resume timing and point the sampler at the thread running the request"""
+        trace = self._current.get()
+        if trace is None:
+            return
+        trace["idle"] = self._idle(trace)
+        trace["paused_at"] = None
+        if trace["sampler"] is not None:
+            trace["sampler"].thread_id = threading.get_ident()
+
+    def _idle(self, trace):
+        """Seconds the request has spent paused so far"""
+        if trace["paused_at"] is None:
+            return trace["idle"]
+        return trace["idle"] + time.perf_counter() - trace["paused_at"]
+
+    def _dump(self, trace, elapsed, stacks):
+        """Write the span timeline and collapsed stacks, rotating old dumps"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(
+            self.output_dir,
+            # Nanosecond suffix keeps names unique and sorted by creation order
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns()}",
+        )
+
+        with open(f"{prefix}.spans.json", "w") as f:
+            json.dump(
+                {
+                    "name": trace["name"],
+                    "elapsed": elapsed,
+                    "spans": trace["spans"],
+                },
+                f,
+                indent=2,
+            )
+
+        # Collapsed stack format, ready for flamegraph.pl or speedscope
+        if stacks:
+            with open(f"{prefix}.collapsed", "w") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write(f"{stack} {count}\n")
+
+        logger.info(f"Request profile written to {prefix}.*")
+
+        dumps = sorted(
+            entry
+            for entry in os.listdir(self.output_dir)
+            if entry.endswith(".spans.json")
+        )
+        for entry in dumps[: max(len(dumps) - self.max_dumps, 0)]:
+            base = entry.removesuffix(".spans.json")
+            for suffix in (".spans.json", ".collapsed"):
+                path = os.path.join(self.output_dir, base + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of one thread once it has been running past a delay"""
+
+    def __init__(self, thread_id, delay, interval, max_samples):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.delay = delay
+        self.interval = interval
+        self.max_samples = max_samples
+        self.stacks = {}
+        self._stopped = threading.Event()
+
+    def run(self):
+        # Fast requests finish before the delay and are never sampled
+        if self._stopped.wait(self.delay):
+            return
+
+        samples = 0
+        while samples < self.max_samples and not self._stopped.is_set():
+            # The request thread is unset while a streaming request is paused,
+            # its pool thread may be running unrelated work meanwhile
+            thread_id = self.thread_id
+            frame = (
+                sys._current_frames().get(thread_id) if thread_id is not None else None
+            )
+            if frame is None:
+                self._stopped.wait(self.interval)
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            samples += 1
+
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop sampling and return the collapsed stack counts"""
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+profiler = RequestProfiler(
+    enabled=os.getenv("PROFILE_REQUESTS", "").lower() in ("1", "true", "yes"),
+    slow_threshold=float(os.getenv("PROFILE_SLOW_THRESHOLD", "5.0")),
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0.1")),
+    output_dir=os.getenv("PROFILE_DIR", "profiles"),
+)
+
+
+quota_ledger = QuotaLedger(
+    path=os.getenv("QUOTA_LEDGER_PATH", "quota_ledger.jsonl"),
+    daily_budget=float(os.getenv("QUOTA_DAILY_BUDGET", "1.00")),
+    hourly_budget=float(os.getenv("QUOTA_HOURLY_BUDGET", "0.25")),
+    client_daily_budget=float(os.getenv("QUOTA_CLIENT_DAILY_BUDGET", "0.20")),
+    client_hourly_budget=float(os.getenv("QUOTA_CLIENT_HOURLY_BUDGET", "0.05")),
+)
+
+QUOTA_EXCEEDED_MESSAGE = "Usage budget reached. Please try again later."
+
+# Metrics logged alongside every completed request, keyed by name
+stats_providers = {}
+
+
+def register_stats(name, provider):
+    """Log the dict returned by provider with every completed request"""
+    stats_providers[name] = provider
+
+
 def monitor_api(func):
-    """Decorator to monitor API usage"""
+    """Decorator to monitor API usage, supports generator functions for streaming"""
     api_monitor = APIMonitor()
 
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        if not api_monitor.check_limit():
-            return "Daily request limit reached. Please try again tomorrow."
-
+    def log_input(args, kwargs):
         # Estimate input size from args and kwargs
-        input_size = sum(len(str(arg)) for arg in args) + sum(
-            len(str(v)) for v in kwargs.values()
+        with profiler.span("monitor_log"):
+            input_size = sum(len(str(arg)) for arg in args) + sum(
+                len(str(v)) for v in kwargs.values()
+            )
+            api_monitor.log_request(input_size)
+
+    def log_completion(elapsed):
+        stats = "".join(
+            f". {name}: {provider()}" for name, provider in stats_providers.items()
         )
-        api_monitor.log_request(input_size)
+        logger.info(f"Request completed in {elapsed:.2f} seconds{stats}")
 
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        elapsed = time.time() - start_time
+    @wraps(func)
+    def wrapper(*args, client_id="anonymous", **kwargs):
+        # Usage recorded during this request is charged to client_id
+        token = quota_ledger.current_client.set(client_id)
+        try:
+            with profiler.profile_request(func.__name__):
+                if not quota_ledger.check():
+                    return QUOTA_EXCEEDED_MESSAGE
+
+                log_input(args, kwargs)
+
+                start_time = time.time()
+                with profiler.span(func.__name__):
+                    result = func(*args, **kwargs)
+                elapsed = time.time() - start_time
+
+                log_completion(elapsed)
+                return result
+        finally:
+            quota_ledger.current_client.reset(token)
+
+    def monitored_stream(args, kwargs, client_id):
+        token = quota_ledger.current_client.set(client_id)
+        try:
+            with profiler.profile_request(func.__name__):
+                if not quota_ledger.check():
+                    yield QUOTA_EXCEEDED_MESSAGE
+                    return
 
-        logger.info(f"Request completed in {elapsed:.2f} seconds")
-        return result
+                log_input(args, kwargs)
+
+                start_time = time.time()
+                with profiler.span(func.__name__):
+                    for value in func(*args, **kwargs):
+                        profiler.pause()
+                        yield value
+                        profiler.resume()
+                elapsed = time.time() - start_time
+
+                log_completion(elapsed)
+        finally:
+            quota_ledger.current_client.reset(token)
+
+    @wraps(func)
+    def stream_wrapper(*args, client_id="anonymous", **kwargs):
+        # Each step may run in a different thread and context, so every step
+        # runs in one context owned by this request
+        context = contextvars.copy_context()
+        steps = monitored_stream(args, kwargs, client_id)
+        try:
+            while True:
+                try:
+                    value = context.run(next, steps)
+                except StopIteration:
+                    return
+                yield value
+        finally:
+            context.run(steps.close)
 
+    if inspect.isgeneratorfunction(func):
+        return stream_wrapper
     return wrapper
@@ -0,0 +1,392 @@
+"""
+Pluggable transports for sending chat completion requests.
+Supports live calls, recording to a cassette file and offline replay.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+
+from linkedinadvice.monitoring import estimate_tokens, logger, quota_ledger
+
+
+def request_key(request):
+    """Stable hash identifying a chat completion request"""
+    payload = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_cassette(path):
+    """Load cassette entries keyed by request hash, later entries win"""
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                key = entry["key"]
+                # Streamed entries only store their chunks, rebuild the text
+                if "chunks" in entry:
+                    entry["text"] = "".join(chunk for _, chunk in entry["chunks"])
+                if not isinstance(entry["text"], str):
+                    continue
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                continue  # Skip a line torn by an interrupted write or malformed
+            entries[key] = entry
+    return entries
+
+
+class OpenAITransport:
+    """Sends requests to the live OpenAI API"""
+
+    def __init__(self, client):
+        if client is None:
+            raise ValueError("OPENAI_API_KEY not found in environment variables")
+        self.client = client
+
+    def complete(self, request):
+        """Return the full response text for a request"""
+        response = self.client.chat.completions.create(**request)
+        self._record_usage(request, response.usage)
+        return response.choices[0].message.content
+
+    def stream(self, request):
+        """Yield response text chunks as they arrive"""
+        for chunk in self.client.chat.completions.create(
+            **request, stream=True, stream_options={"include_usage": True}
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            # The final chunk carries the usage of the whole stream
+            if chunk.usage is not None:
+                self._record_usage(request, chunk.usage)
+
+    def _record_usage(self, request, usage):
+        """Charge reported token usage to the quota ledger"""
+        if usage is not None:
+            quota_ledger.record_usage(
+                request["model"], usage.prompt_tokens, usage.completion_tokens
+            )
+
+
+class RecordingTransport:
+    """Forwards requests to another transport and appends them to a cassette"""
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self._lock = threading.Lock()
+
+    def complete(self, request):
+        """Return the full response text and record it"""
+        text = self.transport.complete(request)
+        self._write(
+            {"key": request_key(request), "model": request["model"], "text": text}
+        )
+        return text
+
+    def stream(self, request):
+        """Yield response chunks and record them with their arrival offsets"""
+        chunks = []
+        start = time.perf_counter()
+        for chunk in self.transport.stream(request):
+            chunks.append([round(time.perf_counter() - start, 4), chunk])
+            yield chunk
+
+        self._write(
+            {
+                "key": request_key(request),
+                "model": request["model"],
+                "chunks": chunks,
+            }
+        )
+
+    def _write(self, entry):
+        """Append one entry to the cassette file"""
+        # A leading newline keeps a line torn by a crash from swallowing this one
+        with self._lock, open(self.path, "a") as f:
+            f.write("\n" + json.dumps(entry, separators=(",", ":")))
+        logger.info(f"Recorded response {entry['key'][:12]} to {self.path}")
+
+
+class ReplayTransport:
+    """Serves recorded responses from a cassette without network access"""
+
+    def __init__(self, path, speed=1.0):
+        self.entries = load_cassette(path)
+        self.speed = speed  # 0 replays instantly, 2.0 replays twice as fast
+
+    def complete(self, request):
+        """Return the recorded response text for a request"""
+        return self._lookup(request)["text"]
+
+    def stream(self, request):
+        """Yield recorded chunks, reproducing their original timing"""
+        entry = self._lookup(request)
+        chunks = entry.get("chunks") or [[0.0, entry["text"]]]
+
+        start = time.perf_counter()
+        for offset, chunk in chunks:
+            if self.speed > 0:
+                delay = offset / self.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield chunk
+
+    def _lookup(self, request):
+        """Find the cassette entry for a request"""
+        entry = self.entries.get(request_key(request))
+        if entry is None:
+            raise LookupError("No recorded response for this request in cassette")
+        return entry
+
+
+class HedgedTransport:
+    """Issues a second identical request when the first one is unusually slow"""
+
+    def __init__(
+        self,
+        transport,
+        percentile=0.9,
+        max_hedge_rate=0.1,
+        max_hedge_burst=2,
+        window=200,
+        min_samples=20,
+        max_workers=8,
+    ):
+        self.transport = transport
+        self.percentile = percentile  # Latency percentile that triggers a hedge
+        self.max_hedge_rate = max_hedge_rate  # Cap on hedges fired per request
+        self.max_hedge_burst = max_hedge_burst  # Hedges that can be saved up
+        # Token bucket refilled by max_hedge_rate per request, so the cap also
+        # holds during a burst of slow requests after a calm period
+        self.hedge_tokens = 0.0
+        self.min_samples = min_samples  # No hedging until enough latencies are seen
+        self.latencies = {
+            "complete": deque(maxlen=window),
+            "stream": deque(maxlen=window),
+        }
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def complete(self, request):
+        """Return the full response text of whichever attempt finishes first"""
+        self._count_request()
+        start = time.perf_counter()
+        # Copy the context so usage is still charged to the requesting client
+        primary = self._executor.submit(
+            copy_context().run, self.transport.complete, request
+        )
+        pending = {primary}
+
+        hedge_after = self._hedge_after("complete")
+        if hedge_after is not None:
+            done, _ = wait(pending, timeout=hedge_after)
+            if not done and self._fire_hedge():
+                pending.add(
+                    self._executor.submit(
+                        copy_context().run, self.transport.complete, request
+                    )
+                )
+
+        # First successful attempt wins, the other is abandoned
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for loser in pending:
+                    loser.cancel()
+                self._record("complete", start, hedged=future is not primary)
+                return future.result()
+        raise error
+
+    def stream(self, request):
+        """Yield chunks of whichever attempt delivers its first token first"""
+        self._count_request()
+        start = time.perf_counter()
+        events = queue.Queue()
+        primary = self._start_stream(request, events)
+        attempts = [primary]
+
+        hedge_after = self._hedge_after("stream")
+        winner = None
+        error = None
+        while winner is None:
+            if len(attempts) == 1 and hedge_after is not None:
+                timeout = max(hedge_after - (time.perf_counter() - start), 0)
+            else:
+                timeout = None
+            try:
+                attempt, kind, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                hedge_after = None
+                if self._fire_hedge():
+                    attempts.append(self._start_stream(request, events))
+                continue
+
+            if kind == "error":
+                error = payload
+                attempts.remove(attempt)
+                if not attempts:
+                    raise error
+            elif kind == "end" and attempt in attempts:
+                attempts.remove(attempt)
+                if not attempts:
+                    return
+            elif kind == "chunk":
+                winner = attempt
+
+        # Cancel the slower attempt and keep streaming from the winner
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt["cancel"].set()
+        self._record("stream", start, hedged=winner is not primary)
+
+        try:
+            yield payload
+            while True:
+                attempt, kind, payload = events.get()
+                if attempt is not winner:
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "error":
+                    raise payload
+                else:
+                    return
+        finally:
+            winner["cancel"].set()
+
+    def stats(self):
+        """Return hedging counters"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges_fired": self.hedges_fired,
+                "hedges_won": self.hedges_won,
+            }
+
+    def _start_stream(self, request, events):
+        """Consume one streaming attempt in the background into the event queue"""
+        attempt = {"cancel": threading.Event()}
+
+        def consume():
+            chunks = self.transport.stream(request)
+            received = ""
+            try:
+                for chunk in chunks:
+                    if attempt["cancel"].is_set():
+                        # Cancelled before the usage chunk, upstream still bills
+                        # the prompt and what it generated so far
+                        prompt = "".join(m["content"] for m in request["messages"])
+                        quota_ledger.record_usage(
+                            request["model"],
+                            estimate_tokens(prompt),
+                            estimate_tokens(received),
+                        )
+                        break
+                    received += chunk
+                    events.put((attempt, "chunk", chunk))
+            except Exception as e:
+                events.put((attempt, "error", e))
+                return
+            finally:
+                # Closing the iterator releases the losing upstream connection
+                if hasattr(chunks, "close"):
+                    chunks.close()
+            events.put((attempt, "end", None))
+
+        threading.Thread(
+            target=copy_context().run, args=(consume,), daemon=True
+        ).start()
+        return attempt
+
+    def _count_request(self):
+        """Count a request and refill the hedge budget"""
+        with self._lock:
+            self.requests += 1
+            self.hedge_tokens = min(
+                self.hedge_tokens + self.max_hedge_rate, self.max_hedge_burst
+            )
+
+    def _hedge_after(self, kind):
+        """Seconds to wait before hedging, or None when hedging is not possible"""
+        with self._lock:
+            latencies = sorted(self.latencies[kind])
+        if len(latencies) < self.min_samples:
+            return None
+        index = min(int(len(latencies) * self.percentile), len(latencies) - 1)
+        return latencies[index]
+
+    def _fire_hedge(self):
+        """Count a hedge if the hedge rate budget allows one"""
+        with self._lock:
+            if self.hedge_tokens < 1:
+                return False
+            self.hedge_tokens -= 1
+            self.hedges_fired += 1
+        logger.info(f"Hedging slow upstream request ({self.hedges_fired} fired)")
+        return True
+
+    def _record(self, kind, start, hedged):
+        """Track the winning latency and whether the hedge won"""
+        with self._lock:
+            self.latencies[kind].append(time.perf_counter() - start)
+            if hedged:
+                self.hedges_won += 1
+                logger.info(f"Hedged request won ({self.hedges_won} won)")
+
+
+class ResponseCache:
+    """In-memory LRU cache of response texts keyed by request hash"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, request):
+        """Return the cached response text, or None"""
+        key = request_key(request)
+        with self._lock:
+            if key not in self.responses:
+                return None
+            self.responses.move_to_end(key)
+            return self.responses[key]
+
+    def put(self, request, text):
+        """Store a response text for a request, evicting the least recently used"""
+        self._put(request_key(request), text)
+
+    def warm_from_cassette(self, path):
+        """Import every recorded response of a cassette into the cache"""
+        entries = load_cassette(path)
+        for key, entry in entries.items():
+            self._put(key, entry["text"])
+        logger.info(
+            f"Warmed response cache with {min(len(entries), self.max_entries)} "
+            f"entries from {path}"
+        )
+        return len(entries)
+
+    def _put(self, key, text):
+        """Insert a response under its key and enforce the size limit"""
+        with self._lock:
+            self.responses[key] = text
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.max_entries:
+                self.responses.popitem(last=False)